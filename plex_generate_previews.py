@@ -1,18 +1,25 @@
 #!/usr/bin/env python3
 
 import sys
-import re
-import subprocess
 import shutil
-import glob
+import subprocess
 import os
 import struct
 import urllib3
-import array
+import mmap
 import time
-import math
+import asyncio
+import shelve
+import tempfile
+import ctypes.util
+import contextlib
+import multiprocessing
+
+try:
+    import fcntl
+except ImportError:  # Windows — fall back to unserialized cache access
+    fcntl = None
 
-import gpustat
 import requests
 
 from datetime import timedelta
@@ -90,6 +97,40 @@ logger.add(
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# The thumbnail filter chains are fixed by the env constants, so build them
+# once at import instead of re-formatting them for every video
+_FPS = round(1 / PLEX_BIF_FRAME_INTERVAL, 6)
+
+_VF_SDR = (
+    f"fps=fps={_FPS}:round=up,"
+    "scale=w=320:h=240:force_original_aspect_ratio=decrease"
+)
+
+_VF_HDR = (
+    f"fps=fps={_FPS}:round=up,"
+    "zscale=t=linear:npl=100,"
+    "format=gbrpf32le,"
+    "zscale=p=bt709,"
+    "tonemap=tonemap=hable:desat=0,"
+    "zscale=t=bt709:m=bt709:r=tv,"
+    "format=yuv420p,"
+    "scale=w=320:h=240:force_original_aspect_ratio=decrease"
+)
+
+_VF_HDR_CUDA = (
+    f"fps=fps={_FPS}:round=up,"
+    "tonemap_cuda=format=p010,"
+    "scale_cuda=w=320:h=240:force_original_aspect_ratio=decrease,"
+    "hwdownload,format=p010"
+)
+
+# Resolve libmediainfo once so every MediaInfo.parse loads it directly
+# instead of searching the library path on each call
+_LIBMEDIAINFO = ctypes.util.find_library('mediainfo')
+
+# On-disk cache of media probes so re-runs skip libmediainfo entirely
+_MEDIAINFO_CACHE = os.path.join(tempfile.gettempdir(), 'plex_generate_previews_mediainfo_cache')
+
 GPU = None
 
 def detect_gpu():
@@ -152,179 +193,647 @@ def human_readable_size(size_bytes):
     if size_bytes == 0:
         return "0 B"
     size_name = ("B", "KiB", "MiB", "GiB", "TiB", "PiB", "EiB", "ZiB", "YiB")
-    i = int(math.floor(math.log(size_bytes, 1024)))
-    p = math.pow(1024, i)
-    s = round(size_bytes / p, 2)
+    # bit_length gives the 1024-power directly without going through floats
+    i = min(max(0, (size_bytes.bit_length() - 1) // 10), len(size_name) - 1)
+    s = round(size_bytes / (1 << (i * 10)), 2)
     return f"{s} {size_name[i]}"
 
 def format_time(seconds):
     """Convert seconds to HH:MM:SS format"""
     return str(timedelta(seconds=int(seconds)))
 
-def generate_images(video_file_param, output_folder):
-    video_file = video_file_param.replace(PLEX_VIDEOS_PATH_MAPPING, PLEX_LOCAL_VIDEOS_PATH_MAPPING)
-    media_info = MediaInfo.parse(video_file)
+# Per-process cache of GPU pipeline stages keyed by target size, so repeated
+# videos with the same dimensions reuse the same CUDA resources.
+_gpu_pipelines = {}
+
+
+def _gpu_pipeline(target_w, target_h, source_format, gpu_id):
+    import PyNvCodec as nvc
+
+    key = (target_w, target_h, source_format, gpu_id)
+    pipeline = _gpu_pipelines.get(key)
+    if pipeline is None:
+        # All three stages run on device surfaces back to back: the decoded
+        # NV12 surface is resized and converted to YUV420 without ever being
+        # downloaded to host memory, and nvjpeg reads the YUV420 surface
+        # directly. The only host copy is the finished JPEG bitstream.
+        resizer = nvc.PySurfaceResizer(target_w, target_h, source_format, gpu_id)
+        converter = nvc.PySurfaceConverter(target_w, target_h, nvc.PixelFormat.NV12, nvc.PixelFormat.YUV420, gpu_id)
+        cc_ctx = nvc.ColorspaceConversionContext(nvc.ColorSpace.BT_709, nvc.ColorRange.MPEG)
+        jpeg_encoder = nvc.PyNvJpegEncoder(gpu_id)
+        pipeline = (resizer, converter, cc_ctx, jpeg_encoder)
+        _gpu_pipelines[key] = pipeline
+    return pipeline
+
+
+def gpu_extract_thumbnails(video_file, output_folder, interval):
+    """
+    Extract one thumbnail every `interval` seconds by decoding on NVDEC via
+    PyNvCodec, with the resize and YUV420 conversion fused on the GPU so no
+    frame data round-trips through host memory before the JPEG encode.
+    Raises ImportError if PyNvCodec is not installed, or any decode error,
+    in which case the caller falls back to the ffmpeg pipeline.
+    """
+    import PyNvCodec as nvc
+
+    gpu_id = 0
+    decoder = nvc.PyNvDecoder(video_file, gpu_id)
+
+    # Fit inside 320x240 preserving aspect ratio (even dimensions for YUV420)
+    width, height = decoder.Width(), decoder.Height()
+    scale = min(320 / width, 240 / height, 1.0)
+    target_w = max(2, int(width * scale)) & ~1
+    target_h = max(2, int(height * scale)) & ~1
+
+    resizer, converter, cc_ctx, jpeg_encoder = _gpu_pipeline(target_w, target_h, decoder.Format(), gpu_id)
+
+    # THUMBNAIL_QUALITY follows ffmpeg's -q:v scale (2-6, lower is better);
+    # nvjpeg wants 1-100 with higher better, so invert: 2 -> 95 ... 6 -> 71
+    jpeg_quality = max(1, min(100, 107 - THUMBNAIL_QUALITY * 6))
+
+    fps = decoder.Framerate()
+    if not fps:
+        # Without a frame rate we can't space the captures and would emit a
+        # thumbnail per decoded frame; ffmpeg's fps= filter handles this case
+        raise ValueError('unknown frame rate for {}'.format(video_file))
+    frames_per_thumbnail = fps * interval
+
+    frame_no = 0
+    thumbnail_no = 0
+    next_capture = 0.0
+    while True:
+        surface = decoder.DecodeSingleSurface()
+        if not surface or surface.Empty():
+            break
+
+        if frame_no < next_capture:
+            frame_no += 1
+            continue
+        frame_no += 1
+        next_capture += frames_per_thumbnail
+
+        surface = resizer.Execute(surface)
+        surface = converter.Execute(surface, cc_ctx)
+        jpeg = jpeg_encoder.Encode(surface, jpeg_quality)
+
+        thumbnail_no += 1
+        with open(os.path.join(output_folder, 'img-{:06d}.jpg'.format(thumbnail_no)), 'wb') as f:
+            f.write(jpeg)
+
+
+@contextlib.contextmanager
+def _mediainfo_cache():
+    """
+    Open the shared probe cache, holding an exclusive flock on a sidecar
+    lock file for the duration. The underlying dbm backends don't tolerate
+    concurrent opens from multiple worker processes (gdbm raises, dumb can
+    corrupt), so all access is serialized through the lock.
+    """
+    if fcntl is None:
+        with shelve.open(_MEDIAINFO_CACHE) as cache:
+            yield cache
+        return
+    with open(_MEDIAINFO_CACHE + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        with shelve.open(_MEDIAINFO_CACHE) as cache:
+            yield cache
+
+
+def probe_media_info(video_file):
+    """
+    Probe HDR format and duration (in ms) with libmediainfo, caching the
+    result on disk keyed by file size and mtime so re-runs skip the probe.
+    The cache is shared by all worker processes and serialized via a lock
+    file; it is best-effort, so any shelve error is treated as a miss.
+    """
+    statinfo = os.stat(video_file)
+    cache_key = '{}:{}:{}'.format(video_file, statinfo.st_size, int(statinfo.st_mtime))
 
-    vf_parameters = (
-        "fps=fps={}:round=up,"
-        "scale=w=320:h=240:force_original_aspect_ratio=decrease"
-        ).format(round(1 / PLEX_BIF_FRAME_INTERVAL, 6))
+    try:
+        with _mediainfo_cache() as cache:
+            if cache_key in cache:
+                return cache[cache_key]
+    except Exception:
+        pass
+
+    if _LIBMEDIAINFO:
+        media_info = MediaInfo.parse(video_file, library_file=_LIBMEDIAINFO)
+    else:
+        media_info = MediaInfo.parse(video_file)
 
-    # Check if we have a HDR Format
+    hdr = False
     if media_info.video_tracks:
         if media_info.video_tracks[0].hdr_format != "None" and media_info.video_tracks[0].hdr_format is not None:
-            vf_parameters = (
-                "fps=fps={}:round=up,"
-                "zscale=t=linear:npl=100,"
-                "format=gbrpf32le,"
-                "zscale=p=bt709,"
-                "tonemap=tonemap=hable:desat=0,"
-                "zscale=t=bt709:m=bt709:r=tv,"
-                "format=yuv420p,"
-                "scale=w=320:h=240:force_original_aspect_ratio=decrease"
-            ).format(round(1 / PLEX_BIF_FRAME_INTERVAL, 6))
-
-    args = [
-        FFMPEG_PATH, "-loglevel", "info", "-skip_frame:v", "nokey", "-threads:0", "1",
-        "-i", video_file, "-an", "-sn", "-dn", "-q:v", str(THUMBNAIL_QUALITY),
-        "-vf", vf_parameters, '{}/img-%06d.jpg'.format(output_folder)
-    ]
+            hdr = True
 
-    start = time.time()
-    hw = False
+    video_track = next((track for track in media_info.tracks if track.track_type == "Video"), None)
+    duration = float(video_track.duration) if video_track and video_track.duration is not None else None
+
+    try:
+        with _mediainfo_cache() as cache:
+            cache[cache_key] = (hdr, duration)
+    except Exception:
+        pass
+
+    return hdr, duration
+
+
+def _rename_thumbnails(output_folder):
+    # Rename images from sequence numbers to their timestamp in seconds
+    with os.scandir(output_folder) as it:
+        for entry in it:
+            name = entry.name
+            if not (name.startswith('img-') and name.endswith('.jpg')):
+                continue
+            frame_no = int(name[4:-4]) - 1
+            frame_second = frame_no * PLEX_BIF_FRAME_INTERVAL
+            os.rename(entry.path, os.path.join(output_folder, '{:010d}.jpg'.format(frame_second)))
+
+
+# Cached output of `ffmpeg -filters`, probed once per process
+_FFMPEG_FILTERS = None
+
+
+def _ffmpeg_has_filter(filter_name):
+    """Check whether the local ffmpeg build ships a given filter"""
+    global _FFMPEG_FILTERS
+    if _FFMPEG_FILTERS is None:
+        try:
+            result = subprocess.run([FFMPEG_PATH, '-hide_banner', '-filters'],
+                                    capture_output=True, text=True, timeout=30)
+            _FFMPEG_FILTERS = result.stdout
+        except Exception:
+            _FFMPEG_FILTERS = ''
+    return filter_name in _FFMPEG_FILTERS
 
+
+# Cached NVML device handle for _count_nvidia_ffmpeg_processes
+_NVML_HANDLE = None
+
+
+def _count_nvidia_ffmpeg_processes():
+    """
+    Count ffmpeg processes on the first NVIDIA GPU straight through NVML
+    with a cached device handle — much cheaper than gpustat, which rebuilds
+    a full per-process report (including psutil lookups) on every query.
+    """
+    import pynvml
+
+    global _NVML_HANDLE
+    if _NVML_HANDLE is None:
+        pynvml.nvmlInit()
+        _NVML_HANDLE = pynvml.nvmlDeviceGetHandleByIndex(0)
+
+    pids = set()
+    for query in (pynvml.nvmlDeviceGetComputeRunningProcesses, pynvml.nvmlDeviceGetGraphicsRunningProcesses):
+        try:
+            pids.update(p.pid for p in query(_NVML_HANDLE))
+        except pynvml.NVMLError:
+            pass
+
+    count = 0
+    for pid in pids:
+        try:
+            with open('/proc/{}/comm'.format(pid)) as f:
+                if f.read().startswith('ffmpeg'):
+                    count += 1
+        except OSError:
+            pass  # process exited, or no /proc on this platform
+    return count
+
+
+def _decide_hw():
+    """Decide whether this process should use hardware decoding for ffmpeg"""
+    if _WORKER_HW is not None:
+        return _WORKER_HW
     if GPU == 'NVIDIA':
-        gpu_stats_query = gpustat.core.new_query()
-        gpu = gpu_stats_query[0] if gpu_stats_query else None
-        if gpu:
-            gpu_ffmpeg = [c for c in gpu.processes if c["command"].lower().startswith("ffmpeg")]
-            if len(gpu_ffmpeg) < GPU_THREADS or CPU_THREADS == 0:
-                hw = True
-                args.insert(5, "-hwaccel")
-                args.insert(6, "cuda")
+        return _count_nvidia_ffmpeg_processes() < GPU_THREADS or CPU_THREADS == 0
     elif GPU:
         # Must be AMD
         gpu_ffmpeg = get_amd_ffmpeg_processes()
-        if len(gpu_ffmpeg) < GPU_THREADS or CPU_THREADS == 0:
-            hw = True
-            args.insert(5, "-hwaccel")
-            args.insert(6, "vaapi")
-            args.insert(7, "-vaapi_device")
-            args.insert(8, GPU)
-            # Adjust vf_parameters for AMD VAAPI
-            vf_parameters = vf_parameters.replace("scale=w=320:h=240:force_original_aspect_ratio=decrease", "format=nv12|vaapi,hwupload,scale_vaapi=w=320:h=240:force_original_aspect_ratio=decrease")
-            args[args.index("-vf") + 1] = vf_parameters
+        return len(gpu_ffmpeg) < GPU_THREADS or CPU_THREADS == 0
+    return False
+
+
+async def _drain_progress(stream, on_progress):
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        key, sep, value = line.strip().partition(b'=')
+        if sep:
+            on_progress(key, value)
+
+
+async def _drain_frames(stream, on_frame):
+    # Split the concatenated MJPEG stream on end-of-image markers. Within
+    # entropy-coded data every 0xFF byte is stuffed with 0x00, so 0xFFD9 only
+    # occurs as the real EOI marker.
+    buffer = bytearray()
+    while True:
+        chunk = await stream.read(1 << 16)
+        if not chunk:
+            break
+        buffer += chunk
+        while True:
+            eoi = buffer.find(b'\xff\xd9')
+            if eoi == -1:
+                break
+            on_frame(bytes(buffer[:eoi + 2]))
+            del buffer[:eoi + 2]
+
+
+async def _run_ffmpeg(args, on_progress, on_frame=None):
+    """
+    Run ffmpeg on the event loop, feeding each -progress key/value pair to
+    on_progress. Reading through asyncio's stream reader batches pipe reads
+    and lets a single worker supervise several children without a blocking
+    read per process. With on_frame set, stdout carries an image2pipe MJPEG
+    stream whose frames are passed to on_frame, and progress is read from
+    stderr instead.
+    """
+    if on_frame is None:
+        proc = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        await _drain_progress(proc.stdout, on_progress)
+    else:
+        proc = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        await asyncio.gather(
+            _drain_frames(proc.stdout, on_frame),
+            _drain_progress(proc.stderr, on_progress),
+        )
 
-    # Get video length
-    video_track = next((track for track in media_info.tracks if track.track_type == "Video"), None)
-    if video_track and video_track.duration is not None:
-        video_length = float(video_track.duration) / 1000  # Convert ms to seconds
-        video_length_formatted = format_time(video_length)
-        total_expected_thumbnails = round(video_length / PLEX_BIF_FRAME_INTERVAL)
+    return await proc.wait()
+
+
+def generate_images(video_file_param, output_folder):
+    return generate_images_batch([(video_file_param, output_folder)])
+
+
+def generate_images_batch(jobs):
+    """
+    Generate thumbnails for one or more (video_file, output_folder) jobs.
+    Jobs that cannot go through NVDEC share a single ffmpeg invocation (one
+    startup, one hwaccel context) with one input and one mapped output
+    pattern per video, which amortizes ffmpeg initialization for short files.
+
+    Returns a dict with one entry per completed job, keyed by output folder:
+    the per-frame size list when the thumbnails were streamed into a single
+    frames.bin body, None when they were written as individual images. Jobs
+    skipped because their file could not be probed have no entry.
+    """
+    ffmpeg_jobs = []
+    frame_sizes = {}
+
+    for video_file_param, output_folder in jobs:
+        video_file = video_file_param.replace(PLEX_VIDEOS_PATH_MAPPING, PLEX_LOCAL_VIDEOS_PATH_MAPPING)
+
+        # A part that can't be probed (missing, unreadable, corrupt) only
+        # takes itself out of the batch; its sibling parts still get previews
+        try:
+            hdr, duration = probe_media_info(video_file)
+            file_size = os.path.getsize(video_file)
+        except Exception as e:
+            logger.error(f'Error probing {video_file} ({type(e).__name__}: {e}). Skipping.')
+            continue
+
+        # Get video length
+        if duration is not None:
+            video_length = duration / 1000  # Convert ms to seconds
+            video_length_formatted = format_time(video_length)
+            total_expected_thumbnails = round(video_length / PLEX_BIF_FRAME_INTERVAL)
+        else:
+            video_length = 0
+            video_length_formatted = "00:00:00"  # Set to 00:00:00 if duration can't be determined
+            total_expected_thumbnails = 0
+
+        file_size_human = human_readable_size(file_size)
+
+        # Decode directly on NVDEC when possible, avoiding the ffmpeg
+        # subprocess entirely. HDR still goes through ffmpeg for its
+        # tonemapping chain.
+        if GPU == 'NVIDIA' and not hdr and _WORKER_HW is not False:
+            try:
+                logger.info(f"Generating thumbnails for [magenta]{video_file}[/magenta] ({video_length_formatted}, {file_size_human}): HW=True (NVDEC)")
+                start = time.time()
+                gpu_extract_thumbnails(video_file, output_folder, PLEX_BIF_FRAME_INTERVAL)
+                _rename_thumbnails(output_folder)
+                processing_time = time.time() - start
+                speed = video_length / processing_time if video_length > 0 else 0
+                logger.info(
+                    f"Generated [bold green]{total_expected_thumbnails}[/] thumbnails "
+                    f"for [magenta]{video_file}[/]: "
+                    f"took [bold green]{round(processing_time)}[/] seconds "
+                    f"@ {speed}x speed (HW=True)"
+                )
+                frame_sizes[output_folder] = None
+                continue
+            except ImportError:
+                logger.warning('PyNvCodec not found. Falling back to ffmpeg for NVIDIA decoding.')
+            except Exception as e:
+                logger.warning(f'NVDEC decoding failed for {video_file} ({type(e).__name__}: {e}). Falling back to ffmpeg.')
+
+        ffmpeg_jobs.append((video_file, output_folder, hdr, video_length, total_expected_thumbnails))
+
+    if not ffmpeg_jobs:
+        return frame_sizes
+
+    hw = _decide_hw()
+
+    # A single output can stream its JPEGs over stdout instead of writing one
+    # tmpfs file per thumbnail; with several mapped outputs the frames would
+    # interleave on the pipe, so batches keep the file-based flow
+    use_pipe = len(ffmpeg_jobs) == 1
+
+    if use_pipe:
+        args = [FFMPEG_PATH, "-loglevel", "error", "-nostats", "-progress", "pipe:2"]
     else:
-        video_length = 0
-        video_length_formatted = "00:00:00"  # Set to 00:00:00 if duration can't be determined
-        total_expected_thumbnails = 0
+        args = [FFMPEG_PATH, "-loglevel", "info", "-nostats", "-progress", "pipe:1"]
+    for video_file, output_folder, hdr, video_length, total_expected_thumbnails in ffmpeg_jobs:
+        if hw:
+            if GPU == 'NVIDIA':
+                args += ["-hwaccel", "cuda"]
+                if not hdr or _ffmpeg_has_filter('tonemap_cuda'):
+                    # Keep decoded frames in GPU memory so scaling (and, when
+                    # the build ships tonemap_cuda, HDR tonemapping) runs on
+                    # the GPU too
+                    args += ["-hwaccel_output_format", "cuda"]
+            else:
+                args += ["-hwaccel", "vaapi", "-vaapi_device", GPU]
+            # Hardware decode: let ffmpeg pick its own thread count so the
+            # CPU-side demux doesn't serialize behind a single thread
+            args += ["-skip_frame:v", "nokey", "-i", video_file]
+        else:
+            # Pure-CPU decode stays single-threaded on purpose so the
+            # CPU_THREADS workers don't fight each other for cores
+            args += ["-skip_frame:v", "nokey", "-threads:0", "1", "-i", video_file]
+
+    for index, (video_file, output_folder, hdr, video_length, total_expected_thumbnails) in enumerate(ffmpeg_jobs):
+        if hdr:
+            if hw and GPU == 'NVIDIA' and _ffmpeg_has_filter('tonemap_cuda'):
+                # Tonemap and scale in GPU memory, downloading only the
+                # finished 320x240 frame; _VF_HDR runs the whole
+                # zscale/tonemap chain on the CPU in float32 otherwise
+                vf_parameters = _VF_HDR_CUDA
+            else:
+                vf_parameters = _VF_HDR
+        else:
+            vf_parameters = _VF_SDR
 
-    file_size = os.path.getsize(video_file)
-    file_size_human = human_readable_size(file_size)
+        if hw and GPU == 'NVIDIA' and not hdr:
+            # Scale on the GPU and only download the finished 320x240 frame
+            vf_parameters = vf_parameters.replace("scale=w=320:h=240:force_original_aspect_ratio=decrease", "scale_cuda=w=320:h=240:force_original_aspect_ratio=decrease,hwdownload,format=nv12")
+        elif hw and GPU != 'NVIDIA':
+            # Adjust vf_parameters for AMD VAAPI
+            vf_parameters = vf_parameters.replace("scale=w=320:h=240:force_original_aspect_ratio=decrease", "format=nv12|vaapi,hwupload,scale_vaapi=w=320:h=240:force_original_aspect_ratio=decrease")
 
-    logger.info(f"Generating thumbnails for [magenta]{video_file}[/magenta] ({video_length_formatted}, {file_size_human}): HW={hw}")
+        args += [
+            "-map", "{}:v:0".format(index), "-an", "-sn", "-dn",
+            "-q:v", str(THUMBNAIL_QUALITY), "-vf", vf_parameters,
+        ]
+        if use_pipe:
+            args += ["-f", "image2pipe", "-vcodec", "mjpeg", "pipe:1"]
+        else:
+            args += ['{}/img-%06d.jpg'.format(output_folder)]
 
-    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        logger.info(f"Generating thumbnails for [magenta]{video_file}[/magenta] ({format_time(video_length)}, {human_readable_size(os.path.getsize(video_file))}): HW={hw}")
 
-    last_progress = 0
-    for line in proc.stderr:
-        time_match = re.search(r'time=(\d{2}):(\d{2}):(\d{2}.\d{2})', line)
-        speed_match = re.search(r'speed=\s*([\d.]+)x', line)
+    # Progress is reported once per invocation; with several inputs the
+    # longest one governs completion
+    batch_length = max(video_length for _, _, _, video_length, _ in ffmpeg_jobs)
+    batch_expected_thumbnails = sum(total for _, _, _, _, total in ffmpeg_jobs)
+    if len(ffmpeg_jobs) == 1:
+        batch_label = ffmpeg_jobs[0][0]
+    else:
+        batch_label = 'batch of {} files'.format(len(ffmpeg_jobs))
 
-        if time_match and speed_match:
-            hours, minutes, seconds = map(float, time_match.groups())
-            current_time = hours * 3600 + minutes * 60 + seconds
-            speed_multiple = float(speed_match.group(1))
+    start = time.time()
 
-            if video_length > 0:
-                progress_percentage = min((current_time / video_length) * 100, 100)
-                thumbnails_generated = int(current_time / PLEX_BIF_FRAME_INTERVAL)
+    last_progress = 0
+    current_time = 0.0
+    speed_multiple = 0.0
+
+    # ffmpeg's -progress output is machine-readable key=value blocks on
+    # stdout (unused otherwise), so progress parsing is a plain split
+    def on_progress(key, value):
+        nonlocal last_progress, current_time, speed_multiple
+        if key == b'out_time_us':
+            try:
+                current_time = int(value) / 1_000_000
+            except ValueError:
+                pass  # out_time_us can be 'N/A' early on
+        elif key == b'speed':
+            try:
+                speed_multiple = float(value.rstrip(b'x'))
+            except ValueError:
+                pass
+        elif key == b'progress':
+            # 'progress' closes each block; flush the accumulated state
+            if batch_length > 0:
+                progress_percentage = min((current_time / batch_length) * 100, 100)
+                thumbnails_generated = int(current_time / PLEX_BIF_FRAME_INTERVAL) * len(ffmpeg_jobs)
 
                 # Only log every 1% progress to avoid cluttering the output
                 if int(progress_percentage) - last_progress >= 1:
-                    logger.info(f"[magenta]{video_file}[/magenta]: "
+                    logger.info(f"[magenta]{batch_label}[/magenta]: "
                                 f"[bold yellow]{int(progress_percentage)}[/]% | "
-                                f"[bold green]{thumbnails_generated}/{total_expected_thumbnails}[/] thumbnails "
+                                f"[bold green]{thumbnails_generated}/{batch_expected_thumbnails}[/] thumbnails "
                                 f"@ [bold blue]{speed_multiple}x[/] speed "
                                 f"(HW={hw})")
                     last_progress = int(progress_percentage)
 
+    if use_pipe:
+        # Append each streamed JPEG to a single body file and record its
+        # size; generate_bif prepends the header without re-reading images
+        output_folder = ffmpeg_jobs[0][1]
+        sizes = []
+        with open(os.path.join(output_folder, 'frames.bin'), 'wb') as body:
+            def on_frame(frame):
+                sizes.append(len(frame))
+                body.write(frame)
+
+            asyncio.run(_run_ffmpeg(args, on_progress, on_frame))
+        frame_sizes[output_folder] = sizes
+    else:
+        asyncio.run(_run_ffmpeg(args, on_progress))
+
     # Compute speed
     end = time.time()
     processing_time = end - start
-    if video_length > 0:
-        speed = video_length / processing_time
+    total_length = sum(video_length for _, _, _, video_length, _ in ffmpeg_jobs)
+    if total_length > 0:
+        speed = total_length / processing_time
     else:
         speed = 0
 
-    # Optimize and Rename Images
-    for image in glob.glob('{}/img*.jpg'.format(output_folder)):
-        frame_no = int(os.path.basename(image).strip('-img').strip('.jpg')) - 1
-        frame_second = frame_no * PLEX_BIF_FRAME_INTERVAL
-        os.rename(image, os.path.join(output_folder, '{:010d}.jpg'.format(frame_second)))
+    for video_file, output_folder, hdr, video_length, total_expected_thumbnails in ffmpeg_jobs:
+        if output_folder not in frame_sizes:
+            _rename_thumbnails(output_folder)
+            frame_sizes[output_folder] = None
+        logger.info(
+            f"Generated [bold green]{total_expected_thumbnails}[/] thumbnails "
+            f"for [magenta]{video_file}[/]: "
+            f"took [bold green]{round(processing_time)}[/] seconds "
+            f"@ {speed}x speed (HW={hw})"
+        )
 
-    logger.info(
-        f"Generated [bold green]{total_expected_thumbnails}[/] thumbnails "
-        f"for [magenta]{video_file}[/]: "
-        f"took [bold green]{round(processing_time)}[/] seconds "
-        f"@ {speed}x speed (HW={HW})"
-    )
+    return frame_sizes
 
-def generate_bif(bif_filename, images_path):
+def generate_bif(bif_filename, images_path, frame_sizes=None):
     """
     Build a .bif file
     @param bif_filename name of .bif file to create
     @param images_path Directory of image files 00000001.jpg
+    @param frame_sizes Per-frame sizes when the thumbnails were streamed into
+           a single frames.bin body by generate_images_batch; the directory
+           is not scanned for individual images in that case
     """
-    magic = [0x89, 0x42, 0x49, 0x46, 0x0d, 0x0a, 0x1a, 0x0a]
+    magic = b'\x89BIF\x0d\x0a\x1a\x0a'
     version = 0
 
-    images = [img for img in os.listdir(images_path) if os.path.splitext(img)[1] == '.jpg']
-    images.sort()
+    if frame_sizes is not None:
+        sizes = frame_sizes
+        bodies = [(os.path.join(images_path, 'frames.bin'), sum(frame_sizes))]
+    else:
+        # One scandir pass gives us names and sizes without extra stat syscalls
+        with os.scandir(images_path) as it:
+            images = sorted((e.name, e.path, e.stat().st_size) for e in it if e.name.endswith('.jpg'))
+        sizes = [size for name, path, size in images]
+        bodies = [(path, size) for name, path, size in images]
 
-    f = open(bif_filename, "wb")
-    array.array('B', magic).tofile(f)
-    f.write(struct.pack("<I", version))
-    f.write(struct.pack("<I", len(images)))
-    f.write(struct.pack("<I", 1000 * PLEX_BIF_FRAME_INTERVAL))
-    array.array('B', [0x00 for x in range(20, 64)]).tofile(f)
+    # Build the header and index table in one buffer, written with one call
+    bif_table_size = 8 + (8 * len(sizes))
+    header = bytearray(64 + bif_table_size)
+    struct.pack_into("<8sIII", header, 0, magic, version, len(sizes), 1000 * PLEX_BIF_FRAME_INTERVAL)
 
-    bif_table_size = 8 + (8 * len(images))
     image_index = 64 + bif_table_size
-    timestamp = 0
+    for timestamp, size in enumerate(sizes):
+        struct.pack_into("<II", header, 64 + 8 * timestamp, timestamp, image_index)
+        image_index += size
+    struct.pack_into("<II", header, 64 + 8 * len(sizes), 0xffffffff, image_index)
+
+    total_size = len(header) + sum(size for path, size in bodies)
+
+    if hasattr(os, 'pwritev'):
+        # Preallocate the full file (avoids extent fragmentation) and push
+        # the header plus the mmap'd image bodies to the kernel in vectored
+        # writes. The images are opened one IOV_MAX-sized chunk at a time and
+        # closed as soon as that chunk hits the disk: each image costs two
+        # fds (file + mmap), so opening all of them at once blows past the
+        # usual 1024-fd soft limit on any video with ~500+ thumbnails
+        fd = os.open(bif_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, total_size)
+
+            paths = [path for path, size in bodies if size > 0]
+            offset = 0
+            carry = memoryview(header)
+            next_path = 0
+            while carry is not None or next_path < len(paths):
+                sources = []
+                iov = []
+                if carry is not None:
+                    iov.append(carry)
+                    carry = None
+                try:
+                    # 100 images per chunk is ~200 concurrent fds, well under
+                    # typical limits, and also keeps each call under IOV_MAX
+                    while next_path < len(paths) and len(iov) < 100:
+                        src = open(paths[next_path], "rb")
+                        sources.append(src)
+                        mm = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+                        sources.append(mm)
+                        iov.append(memoryview(mm))
+                        next_path += 1
+
+                    index = 0
+                    while index < len(iov):
+                        written = os.pwritev(fd, iov[index:], offset)
+                        offset += written
+                        # Advance past fully written buffers; re-slice a partial one
+                        for buf in iov[index:]:
+                            if written >= len(buf):
+                                written -= len(buf)
+                                index += 1
+                            else:
+                                iov[index] = buf[written:]
+                                break
+                finally:
+                    # Memoryviews must be released before the mmaps can be closed
+                    for buf in iov:
+                        buf.release()
+                    iov.clear()
+                    for source in reversed(sources):
+                        source.close()
+        finally:
+            os.close(fd)
+    else:
+        with open(bif_filename, "wb") as f:
+            f.write(header)
+            f.flush()  # sendfile below writes to the fd, bypassing Python's buffer
 
-    # Get the length of each image
-    for image in images:
-        statinfo = os.stat(os.path.join(images_path, image))
-        f.write(struct.pack("<I", timestamp))
-        f.write(struct.pack("<I", image_index))
-        timestamp += 1
-        image_index += statinfo.st_size
+            # Concatenate the images with sendfile so the kernel copies the
+            # page-cache pages directly, without a userspace round-trip. Where
+            # sendfile doesn't exist either, write each image through a
+            # read-only mmap instead of read(), which still avoids allocating
+            # an intermediate bytes object per image.
+            for path, size in bodies:
+                with open(path, "rb") as src:
+                    if hasattr(os, 'sendfile'):
+                        os.sendfile(f.fileno(), src.fileno(), 0, size)
+                    else:
+                        with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                            f.write(mm)
 
-    f.write(struct.pack("<I", 0xffffffff))
-    f.write(struct.pack("<I", image_index))
 
-    # Now copy the images
-    for image in images:
-        data = open(os.path.join(images_path, image), "rb").read()
-        f.write(data)
+# Per-worker Plex client, built once by _init_worker so each worker reuses a
+# single session (and its TLS connection) across every item it processes
+_PLEX = None
 
-    f.close()
+# Fixed hardware-accel role for this worker: True for the first GPU_THREADS
+# workers, False for the rest, None when running outside the pool (in which
+# case generate_images falls back to polling the GPU for free slots)
+_WORKER_HW = None
 
 
-def process_item(item_key):
+def _init_worker(worker_counter=None, gpu=None):
+    global _PLEX, _WORKER_HW, GPU
+
+    # Workers start via forkserver and don't inherit post-import state from
+    # the parent process, so the detected GPU is passed in explicitly
+    GPU = gpu
+
     sess = requests.Session()
     sess.verify = False
-    plex = PlexServer(PLEX_URL, PLEX_TOKEN, timeout=PLEX_TIMEOUT, session=sess)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=8)
+    sess.mount('http://', adapter)
+    sess.mount('https://', adapter)
+    _PLEX = PlexServer(PLEX_URL, PLEX_TOKEN, timeout=PLEX_TIMEOUT, session=sess)
+
+    if worker_counter is not None and GPU:
+        with worker_counter.get_lock():
+            worker_index = worker_counter.value
+            worker_counter.value += 1
+        _WORKER_HW = worker_index < GPU_THREADS or CPU_THREADS == 0
+
+
+def process_item(item):
+    item_key, parts_hint = item
+
+    # Skip the Plex round-trip entirely when every part we learned about from
+    # the library listing already has its previews — the common case on
+    # incremental runs. MediaPart.indexes is 'sd' when the server already has
+    # BIF previews for the part; anything else falls through to the tree
+    # query, which remains the authoritative check.
+    if parts_hint and all(part_indexes == 'sd' for part_file, part_indexes in parts_hint):
+        return
+
+    data = _PLEX.query('{}/tree'.format(item_key))
 
-    data = plex.query('{}/tree'.format(item_key))
+    # Collect every media part that needs previews, then generate them with
+    # one ffmpeg invocation so multi-part items pay the startup cost once
+    pending = []
 
     for media_part in data.findall('.//MediaPart'):
         if 'hash' in media_part.attrib:
@@ -364,25 +873,38 @@ def process_item(item_key):
                     logger.error('Error generating images for {}. `{}:{}` error when creating tmp path {}'.format(media_file, type(e).__name__, str(e), tmp_path))
                     continue
 
-                try:
-                    generate_images(media_part.attrib['file'], tmp_path)
-                except Exception as e:
-                    logger.error('Error generating images for {}. `{}: {}` error when generating images'.format(media_file, type(e).__name__, str(e)))
-                    if os.path.exists(tmp_path):
-                        shutil.rmtree(tmp_path)
-                    continue
+                pending.append((media_file, tmp_path, index_bif))
 
-                try:
-                    generate_bif(index_bif, tmp_path)
-                except Exception as e:
-                    # Remove bif, as it prob failed to generate
-                    if os.path.exists(index_bif):
-                        os.remove(index_bif)
-                    logger.error('Error generating images for {}. `{}:{}` error when generating bif'.format(media_file, type(e).__name__, str(e)))
-                    continue
-                finally:
-                    if os.path.exists(tmp_path):
-                        shutil.rmtree(tmp_path)
+    if not pending:
+        return
+
+    try:
+        frame_sizes = generate_images_batch([(media_file, tmp_path) for media_file, tmp_path, index_bif in pending])
+    except Exception as e:
+        for media_file, tmp_path, index_bif in pending:
+            logger.error('Error generating images for {}. `{}: {}` error when generating images'.format(media_file, type(e).__name__, str(e)))
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+        return
+
+    for media_file, tmp_path, index_bif in pending:
+        # Parts whose probe failed were skipped by the batch; don't turn the
+        # empty tmp folder into a zero-frame BIF that marks the part as done
+        if tmp_path not in frame_sizes:
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+            continue
+
+        try:
+            generate_bif(index_bif, tmp_path, frame_sizes.get(tmp_path))
+        except Exception as e:
+            # Remove bif, as it prob failed to generate
+            if os.path.exists(index_bif):
+                os.remove(index_bif)
+            logger.error('Error generating images for {}. `{}:{}` error when generating bif'.format(media_file, type(e).__name__, str(e)))
+        finally:
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
 
 
 def run():
@@ -392,24 +914,46 @@ def run():
 
     plex = PlexServer(PLEX_URL, PLEX_TOKEN, session=sess)
 
+    # forkserver forks workers from a clean server process with the heavy
+    # modules pre-imported: no copy-on-write of the parent's NVML/session
+    # state and no re-import cost per worker
+    ctx = multiprocessing.get_context('forkserver')
+    ctx.set_forkserver_preload(['plexapi.server', 'requests', 'pymediainfo', 'loguru'])
+
+    # Hands out worker indexes so the first GPU_THREADS workers get the GPU
+    worker_counter = ctx.Value('i', 0)
+
+    # Collect every item across all sections first and process them as one
+    # flat stream through a single pool, so workers stay busy across section
+    # boundaries instead of draining and rebuilding the pool per section
+    media = []
     for section in plex.library.sections():
         logger.info('Getting the media files from library \'{}\''.format(section.title))
 
         if section.METADATA_TYPE == 'episode':
-            media = [m.key for m in section.search(libtype='episode')]
+            items = section.search(libtype='episode')
         elif section.METADATA_TYPE == 'movie':
-            media = [m.key for m in section.search()]
+            items = section.search()
         else:
             logger.info('Skipping library {} as \'{}\' is unsupported'.format(section.title, section.METADATA_TYPE))
             continue
 
-        logger.info('Got {} media files for library {}'.format(len(media), section.title))
+        # Pair each item key with the part file/indexes info already present
+        # in the search results, so workers can skip already-processed items
+        # without another round-trip to the Plex server
+        for m in items:
+            parts_hint = [(part.file, getattr(part, 'indexes', None)) for item_media in m.media for part in item_media.parts]
+            media.append((m.key, parts_hint))
+
+        logger.info('Got {} media files for library {}'.format(len(items), section.title))
+
+    logger.info('Got {} media files in total'.format(len(media)))
 
-        with Progress(SpinnerColumn(), *Progress.get_default_columns(), MofNCompleteColumn(), console=console) as progress:
-            with ProcessPoolExecutor(max_workers=CPU_THREADS + GPU_THREADS) as process_pool:
-                futures = [process_pool.submit(process_item, key) for key in media]
-                for future in progress.track(futures):
-                    future.result()
+    with Progress(SpinnerColumn(), *Progress.get_default_columns(), MofNCompleteColumn(), console=console) as progress:
+        with ProcessPoolExecutor(max_workers=CPU_THREADS + GPU_THREADS, mp_context=ctx, initializer=_init_worker, initargs=(worker_counter, GPU)) as process_pool:
+            futures = [process_pool.submit(process_item, key) for key in media]
+            for future in progress.track(futures):
+                future.result()
 
 
 if __name__ == '__main__':